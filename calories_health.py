@@ -2,32 +2,37 @@
 from dotenv import load_dotenv
 load_dotenv()  # local development only; .env must be in .gitignore
 
+import hashlib
+import io
 import os
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import streamlit as st
-from PIL import Image
-import google.generativeai as genai
-from google.api_core.exceptions import InvalidArgument, ResourceExhausted, GoogleAPIError
+
+# google.generativeai and PIL are heavy imports that would slow every cold
+# start; they are imported lazily inside the functions that need them, so
+# only the first Analyze click pays the cost (then sys.modules caches them).
 
 # --- Configuration / keys ---
-GOOGLE_API_KEY = None
-try:
-    GOOGLE_API_KEY = st.secrets["GOOGLE_API_KEY"]
-except Exception:
-    GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
-
-CALORIE_NINJAS_KEY = None
-try:
-    CALORIE_NINJAS_KEY = st.secrets["CALORIE_NINJAS_KEY"]
-except Exception:
-    CALORIE_NINJAS_KEY = os.getenv("CALORIE_NINJAS_KEY")
-
-# Optional configure for genai client (no-op for some SDK versions)
-try:
-    if GOOGLE_API_KEY:
-        genai.configure(api_key=GOOGLE_API_KEY)
-except Exception:
-    pass
+@st.cache_resource
+def _keys():
+    """Read API keys once per process (secrets first, then environment)."""
+    def get_key(name):
+        try:
+            return st.secrets[name]
+        except Exception:
+            return os.getenv(name)
+
+    return {
+        "google": get_key("GOOGLE_API_KEY"),
+        "ninjas": get_key("CALORIE_NINJAS_KEY"),
+    }
+
+GOOGLE_API_KEY = _keys()["google"]
+CALORIE_NINJAS_KEY = _keys()["ninjas"]
 
 if not GOOGLE_API_KEY:
     st.error("""
@@ -40,35 +45,136 @@ Fix:
     st.stop()
 
 # --- Helpers ---
-def get_gemini_response(prompt_text, image_parts, user_text):
-    """
-    Call Gemini and return a text response.
-    image_parts should be a list-of-dict prepared by input_image_setup (or None).
-    user_text is optional extra context passed before the prompt.
-    """
+@st.cache_resource
+def _get_model(name="gemini-2.5-flash"):
+    """Build the Gemini model client once per process and reuse it across reruns."""
+    import google.generativeai as genai
+
+    # Optional configure for genai client (no-op for some SDK versions)
     try:
-        model = genai.GenerativeModel("gemini-2.5-flash")
-        response = model.generate_content([user_text, image_parts[0] if image_parts else None, prompt_text])
-        return getattr(response, "text", str(response))
-    except InvalidArgument as e:
+        if GOOGLE_API_KEY:
+            genai.configure(api_key=GOOGLE_API_KEY)
+    except Exception:
+        pass
+    return genai.GenerativeModel(name)
+
+_GEMINI_CACHE_MAX_ENTRIES = 128
+
+@st.cache_resource
+def _gemini_cache():
+    """Per-process store of completed Gemini answers, shared by both the
+    blocking and streaming paths. Only successful responses are stored."""
+    return {}
+
+def _gemini_cache_key(prompt_text, image_part, user_text):
+    """Cache key from prompt + user text + a content hash of the image."""
+    image_hash = hashlib.sha256(image_part["data"]).hexdigest() + image_part["mime_type"] if image_part else ""
+    return (prompt_text, image_hash, user_text)
+
+def _gemini_cache_store(key, text):
+    cache = _gemini_cache()
+    if len(cache) >= _GEMINI_CACHE_MAX_ENTRIES:
+        cache.pop(next(iter(cache)))
+    cache[key] = text
+
+def _gemini_error_message(e):
+    """Map Gemini exceptions to the user-facing messages shown in the UI."""
+    from google.api_core.exceptions import GoogleAPIError, InvalidArgument, ResourceExhausted
+
+    if isinstance(e, InvalidArgument):
         if "API key expired" in str(e) or "API_KEY_INVALID" in str(e):
             return "⚠️ Your Google API key is invalid or expired. Renew it in Google AI Studio."
         return f"❌ Invalid argument: {e}"
-    except ResourceExhausted:
+    if isinstance(e, ResourceExhausted):
         return "🚫 Google API quota exceeded. Try again later."
-    except GoogleAPIError as e:
+    if isinstance(e, GoogleAPIError):
         return f"❗ Google API error: {e}"
+    return f"💥 Unexpected error: {e}"
+
+def _stream_text(response, cache_key):
+    """
+    Yield text chunks from a streaming Gemini response, surfacing errors as
+    text. The accumulated answer is cached only if the stream completes.
+    """
+    parts = []
+    try:
+        for chunk in response:
+            text = getattr(chunk, "text", "")
+            if text:
+                parts.append(text)
+                yield text
+    except Exception as e:
+        yield _gemini_error_message(e)
+        return
+    _gemini_cache_store(cache_key, "".join(parts))
+
+def get_gemini_response(prompt_text, image_parts, user_text, stream=False):
+    """
+    Call Gemini and return a text response.
+    image_parts should be a list-of-dict prepared by input_image_setup (or None).
+    user_text is optional extra context passed before the prompt.
+    With stream=True, return an iterator of text chunks (for st.write_stream)
+    instead of waiting for the full answer. Repeat analyses of the same
+    inputs are served from the response cache and skip the paid API call.
+    """
+    image_part = image_parts[0] if image_parts else None
+    key = _gemini_cache_key(prompt_text, image_part, user_text)
+    cached = _gemini_cache().get(key)
+    if cached is not None:
+        return iter([cached]) if stream else cached
+    if stream:
+        try:
+            response = _get_model().generate_content([user_text, image_part, prompt_text], stream=True)
+        except Exception as e:
+            return iter([_gemini_error_message(e)])
+        return _stream_text(response, key)
+    try:
+        response = _get_model().generate_content([user_text, image_part, prompt_text])
+        text = getattr(response, "text", str(response))
     except Exception as e:
-        return f"💥 Unexpected error: {e}"
+        return _gemini_error_message(e)
+    _gemini_cache_store(key, text)
+    return text
+
+@st.cache_data(
+    show_spinner=False,
+    max_entries=4,
+    hash_funcs={"streamlit.runtime.uploaded_file_manager.UploadedFile": lambda f: (f.file_id, f.size)},
+)
+def _decode_upload(uploaded_file):
+    """
+    Materialize the upload's raw bytes and decoded PIL image exactly once
+    per upload, shared by the preview and the Gemini preprocessing path.
+    Entries are large (decoded pixels), so keep only the last few uploads.
+    """
+    from PIL import Image
+
+    raw = uploaded_file.getvalue()
+    return raw, Image.open(io.BytesIO(raw))
+
+def _preprocess_image(img, max_side=1024, quality=85):
+    """
+    Cap the longest image side at max_side and re-encode to JPEG.
+    Keeps bytes-on-wire and vision tokens small for multi-MB phone photos.
+    """
+    from PIL import Image
+
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    img.thumbnail((max_side, max_side), Image.LANCZOS)
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=quality, optimize=True)
+    return buf.getvalue()
 
 def input_image_setup(uploaded_file):
     if uploaded_file is None:
         return None
     try:
-        bytes_data = uploaded_file.getvalue()
+        _, img = _decode_upload(uploaded_file)
+        bytes_data = _preprocess_image(img)
         image_parts = [
             {
-                "mime_type": uploaded_file.type,
+                "mime_type": "image/jpeg",
                 "data": bytes_data
             }
         ]
@@ -77,44 +183,65 @@ def input_image_setup(uploaded_file):
         st.warning(f"Unable to prepare image for upload: {e}")
         return None
 
-@st.cache_data(show_spinner=False)
+@st.cache_resource
+def _http_session():
+    """
+    Shared requests.Session with connection pooling and retries.
+    Keep-alive amortizes the TCP+TLS handshake across CalorieNinjas calls.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=8,
+        max_retries=Retry(total=2, backoff_factor=0.3, status_forcelist=[429, 502, 503, 504]),
+    )
+    session.mount("https://", adapter)
+    return session
+
 def lookup_calories_calorieninjas(free_text: str):
     """
-    Query CalorieNinjas and return readable string. Cached in session.
+    Query CalorieNinjas and return readable string.
+    Normalizes the query so whitespace/case variants share one cache entry.
+    The key check and error-to-message handling live here, outside the
+    cache, so failures are never persisted.
     """
     if not CALORIE_NINJAS_KEY:
         return "Calorie lookup unavailable: CALORIE_NINJAS_KEY not set."
-
-    url = "https://api.calorieninjas.com/v1/nutrition"
-    headers = {"X-Api-Key": CALORIE_NINJAS_KEY}
-    params = {"query": free_text}
     try:
-        r = requests.get(url, headers=headers, params=params, timeout=8)
-        r.raise_for_status()
-        data = r.json()
-        items = data.get("items", [])
-        if not items:
-            return "No nutrition data found for that query."
-
-        lines = []
-        total_cal = 0
-        for item in items:
-            name = item.get("name", "item")
-            cal = item.get("calories", 0)
-            serving = item.get("serving_size", "")
-            if serving:
-                lines.append(f"{name} ({serving}) — {cal} kcal")
-            else:
-                lines.append(f"{name} — {cal} kcal")
-            total_cal += cal
-        lines.append("----")
-        lines.append(f"Estimated total: {total_cal} kcal")
-        return "\n".join(lines)
+        return _lookup_calories_cached(free_text.strip().lower())
     except requests.exceptions.RequestException as e:
         return f"Error calling CalorieNinjas: {e}"
     except Exception as e:
         return f"Unexpected error in calorie lookup: {e}"
 
+@st.cache_data(show_spinner=False, ttl=60 * 60 * 24, max_entries=1024, persist="disk")
+def _lookup_calories_cached(free_text: str):
+    """
+    Cached CalorieNinjas query. Nutrition data is essentially static, so
+    cache to disk for a day and cap entries to bound memory growth.
+    Raises on HTTP errors so only successful lookups are cached.
+    """
+    url = "https://api.calorieninjas.com/v1/nutrition"
+    headers = {"X-Api-Key": CALORIE_NINJAS_KEY}
+    params = {"query": free_text}
+    r = _http_session().get(url, headers=headers, params=params, timeout=8)
+    r.raise_for_status()
+    data = r.json()
+    items = data.get("items", [])
+    if not items:
+        return "No nutrition data found for that query."
+
+    rows = [
+        (item.get("name", "item"), item.get("calories", 0), item.get("serving_size", ""))
+        for item in items
+    ]
+    lines = [
+        f"{name} ({serving}) — {cal} kcal" if serving else f"{name} — {cal} kcal"
+        for name, cal, serving in rows
+    ]
+    total_cal = sum(cal for _, cal, _ in rows)
+    return "\n".join(lines + ["----", f"Estimated total: {total_cal} kcal"])
+
 # --- UI ---
 st.set_page_config(page_title="Nutrition Analyzer", layout="wide")
 st.title("🍽️ Nutrition Analyzer — single input (text + optional image)")
@@ -134,14 +261,11 @@ unified_input = st.text_input(
 uploaded_file = st.file_uploader("Upload an image of the meal (optional)", type=["jpg", "jpeg", "png"])
 if uploaded_file:
     try:
-        display_image = Image.open(uploaded_file)
+        _, display_image = _decode_upload(uploaded_file)
         st.image(display_image, caption="Uploaded image", use_container_width=True)
     except Exception:
         st.warning("Unable to open the uploaded image for preview.")
 
-# One analyze button
-analyze = st.button("Analyze")
-
 # Prompt used by Gemini (image analysis). You can edit this wording.
 input_prompt = """You are an expert nutritionist. Look at the image and identify each food item,
 estimate its calories, and list results in this format:
@@ -152,41 +276,59 @@ estimate its calories, and list results in this format:
 Also provide short notes about portion size assumptions you used.
 """
 
-# Handle Analyze click
-if analyze:
+# Analyze button + handler live in a fragment so a click re-runs only this
+# block instead of the whole script (secrets, layout, widgets above stay put).
+@st.fragment
+def _analyze_block(unified_input, uploaded_file):
+    if not st.button("Analyze"):
+        return
     if uploaded_file is None and (not unified_input or not unified_input.strip()):
         st.error("Please upload an image or type a dish/ingredients (or both).")
     else:
         # Side-by-side columns for results
         col_img, col_text = st.columns(2)
 
-        # GEMINI IMAGE ANALYSIS
-        with col_img:
-            st.subheader("Image analysis")
-            if uploaded_file is None:
-                st.info("No image provided. Upload an image to run Gemini-based analysis.")
-            else:
-                image_parts = input_image_setup(uploaded_file)
-                if image_parts is None:
+        # Both calls are independent network-bound operations; dispatch them
+        # together so total latency is max(gemini, ninjas) rather than the sum.
+        image_parts = input_image_setup(uploaded_file) if uploaded_file is not None else None
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            fut_gemini = None
+            if image_parts is not None:
+                # Pass unified_input as user_text (extra context) to Gemini.
+                # stream=True blocks in the worker only until the first chunk.
+                fut_gemini = executor.submit(
+                    get_gemini_response, input_prompt, image_parts, unified_input or "", stream=True
+                )
+            fut_ninjas = None
+            if unified_input and unified_input.strip():
+                fut_ninjas = executor.submit(lookup_calories_calorieninjas, unified_input)
+
+            # GEMINI IMAGE ANALYSIS
+            with col_img:
+                st.subheader("Image analysis")
+                if uploaded_file is None:
+                    st.info("No image provided. Upload an image to run Gemini-based analysis.")
+                elif image_parts is None:
                     st.warning("Could not prepare the image for analysis.")
                 else:
                     with st.spinner("Analyzing image with Gemini…"):
-                        # Pass unified_input as user_text (extra context) to Gemini
-                        gemini_result = get_gemini_response(input_prompt, image_parts, unified_input or "")
-                    st.write(gemini_result)
-
-        # TEXT LOOKUP (CalorieNinjas)
-        with col_text:
-            st.subheader("Quick text lookup")
-            if not unified_input or not unified_input.strip():
-                if not CALORIE_NINJAS_KEY:
-                    st.info("CalorieNinjas key not set. Add CALORIE_NINJAS_KEY to secrets or .env to enable text lookup.")
+                        gemini_chunks = fut_gemini.result()
+                    st.write_stream(gemini_chunks)
+
+            # TEXT LOOKUP (CalorieNinjas)
+            with col_text:
+                st.subheader("Quick text lookup")
+                if fut_ninjas is None:
+                    if not CALORIE_NINJAS_KEY:
+                        st.info("CalorieNinjas key not set. Add CALORIE_NINJAS_KEY to secrets or .env to enable text lookup.")
+                    else:
+                        st.info("Type a dish or short ingredient list above to run a quick text lookup.")
                 else:
-                    st.info("Type a dish or short ingredient list above to run a quick text lookup.")
-            else:
-                with st.spinner("Fetching quick text lookup..."):
-                    text_lookup = lookup_calories_calorieninjas(unified_input)
-                st.text(text_lookup)
+                    with st.spinner("Fetching quick text lookup..."):
+                        text_lookup = fut_ninjas.result()
+                    st.text(text_lookup)
+
+_analyze_block(unified_input, uploaded_file)
 
 # Footer tips
 st.markdown("---")